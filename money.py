@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2021 kichinosukey.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import atexit
+import json
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from bbc1.core import bbclib
+from bbc1.lib import app_support_lib, id_lib, token_lib
+from flask import Flask, Response, abort, g, jsonify, request
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+else:
+    _dumps = json.dumps
+
+
+NAME_OF_DB = 'money_db'
+
+LABEL_JOINED = 'joined the game'
+LABEL_SALT = 'money-inflation-game'
+
+DEFAULT_BASETIME = 0
+DEFAULT_COUNT = 50
+
+user_table_definition = [
+    ["user_id", "BLOB"],
+    ["name", "TEXT"],
+    ["public_key", "BLOB"],
+    ["private_key", "BLOB"],
+]
+
+currency_table_definition = [
+    ["user_id", "BLOB"],
+    ["name", "TEXT"],
+    ["public_key", "BLOB"],
+    ["private_key", "BLOB"],
+]
+
+tx_table_definition = [
+    ["tx_id", "BLOB"],
+    ["timestamp", "INTEGER"],
+    ["mint_id", "BLOB"],
+    ["from_name", "TEXT"],
+    ["to_name", "TEXT"],
+    ["amount", "TEXT"],
+    ["label", "TEXT"],
+]
+
+IDX_TX_ID     = 0
+IDX_TIMESTAMP = 1
+IDX_MINT_ID   = 2
+IDX_FROM_NAME = 3
+IDX_TO_NAME   = 4
+IDX_AMOUNT    = 5
+IDX_LABEL     = 6
+
+IDX_USER_ID     = 0
+IDX_NAME        = 1
+IDX_PUBLIC_KEY  = 2
+IDX_PRIVATE_KEY = 3
+
+domain_id = bbclib.get_new_id("money_inflation_game", include_timestamp=False)
+label_group_id = bbclib.get_new_id("money_inflation_game_label_group",
+        include_timestamp=False)
+
+_JOINED_LABEL = app_support_lib.TransactionLabel(label_group_id,
+        label_id=app_support_lib.TransactionLabel.create_label_id(
+                LABEL_JOINED, LABEL_SALT))
+
+
+@lru_cache(maxsize=256)
+def _get_label(s_label):
+    return app_support_lib.TransactionLabel(label_group_id,
+            label_id=app_support_lib.TransactionLabel.create_label_id(
+                    s_label, LABEL_SALT))
+
+
+# Converter for rows from the paged tx query (rowid prepended to the
+# table columns, window count appended). Generated with the positions
+# baked in as literals so list(map(...)) runs it without any global
+# loads per row.
+_TX_ROW_TO_DICT = eval("lambda row: {"
+        "'timestamp': row[%d], 'from_name': row[%d], 'to_name': row[%d], "
+        "'amount': row[%d], 'label': row[%d]}" % (
+                IDX_TIMESTAMP + 1, IDX_FROM_NAME + 1, IDX_TO_NAME + 1,
+                IDX_AMOUNT + 1, IDX_LABEL + 1))
+
+
+@lru_cache(maxsize=1024)
+def _keypair(pubkey, privkey):
+    return bbclib.KeyPair(privkey=privkey, pubkey=pubkey)
+
+
+class User:
+
+    def __init__(self, user_id, name, keypair):
+        self.user_id = user_id
+        self.name = name
+        self.keypair = keypair
+
+    @staticmethod
+    def from_row(row):
+        return User(
+            row[IDX_USER_ID],
+            row[IDX_NAME],
+            _keypair(row[IDX_PUBLIC_KEY], row[IDX_PRIVATE_KEY])
+        )
+
+
+class Store:
+
+    def __init__(self):
+        self.db = app_support_lib.Database()
+        self.db.setup_db(domain_id, NAME_OF_DB)
+        # per-connection setting; journal_mode is persistent in the DB
+        # file and set once in setup().
+        self.db.exec_sql(domain_id, NAME_OF_DB, 'pragma synchronous=NORMAL')
+
+    def close(self):
+        self.db.close_db(domain_id, NAME_OF_DB)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _sql(template, table):
+        return sys.intern(template % table)
+
+    def get_tx_list(self, mint_id, name=None, basetime=DEFAULT_BASETIME,
+            after_rowid=None, offset=0, count=DEFAULT_COUNT):
+        sql = ('select rowid, *, count(*) over () from tx_table '
+                'where mint_id=? and timestamp>=?')
+        args = [mint_id, basetime]
+        if name is not None:
+            sql += ' and (from_name=? or to_name=?)'
+            args.extend([name, name])
+        if after_rowid is None:
+            # offset shim for clients that do not send a cursor yet;
+            # deep paging should use after_rowid.
+            sql += ' order by rowid desc limit ?,?'
+            args.extend([offset, count])
+        else:
+            sql += ' and rowid<? order by rowid desc limit ?'
+            args.extend([after_rowid, count])
+        rows = self.db.exec_sql(domain_id, NAME_OF_DB, sql, *args)
+        count_all = rows[0][-1] if len(rows) > 0 else 0
+        next_rowid = rows[-1][0] if len(rows) > 0 else None
+        dics = list(map(_TX_ROW_TO_DICT, rows))
+        return count_all, next_rowid, dics
+
+    def get_user(self, user_id, table):
+        rows = self.db.exec_sql(domain_id, NAME_OF_DB,
+                self._sql('select * from %s where user_id=?', table), user_id)
+        if len(rows) <= 0:
+            return None
+        return User.from_row(rows[0])
+
+    def get_user_names(self, table):
+        return self.db.exec_sql(domain_id, NAME_OF_DB,
+                self._sql('select user_id, name from %s', table))
+
+    def name_taken(self, name):
+        rows = self.db.exec_sql(domain_id, NAME_OF_DB,
+                "select 'user' from user_table where name=? "
+                "union all "
+                "select 'currency' from currency_table where name=? "
+                "limit 1", name, name)
+        return rows[0][0] if len(rows) > 0 else None
+
+    def read_user(self, name, table):
+        rows = self.db.exec_sql(domain_id, NAME_OF_DB,
+                self._sql('select * from %s where name=?', table), name)
+        if len(rows) <= 0:
+            return None
+        return User.from_row(rows[0])
+
+    def replace_user_keypair(self, user, table):
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                self._sql('update %s set public_key=?, private_key=? '
+                        'where user_id=?', table),
+                user.keypair.public_key, user.keypair.private_key,
+                user.user_id)
+
+    def setup(self):
+        self.db.exec_sql(domain_id, NAME_OF_DB, 'pragma journal_mode=WAL')
+        self.db.create_table_in_db(domain_id, NAME_OF_DB, 'user_table',
+                user_table_definition, indices=[1])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB, 'currency_table',
+                currency_table_definition, indices=[1])
+        self.db.create_table_in_db(domain_id, NAME_OF_DB, 'tx_table',
+                tx_table_definition)
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                'create index if not exists tx_mint_ts '
+                'on tx_table (mint_id, timestamp desc)')
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                'create index if not exists tx_mint_from '
+                'on tx_table (mint_id, from_name)')
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                'create index if not exists tx_mint_to '
+                'on tx_table (mint_id, to_name)')
+
+    def write_tx(self, tx_id, timestamp, mint_id, from_name, to_name,
+            amount, label):
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                'insert into tx_table values (?, ?, ?, ?, ?, ?, ?)',
+                tx_id, timestamp, mint_id, from_name, to_name, amount, label)
+
+    def write_txs(self, rows):
+        # exec_sql commits after every statement, so the batch goes
+        # through the raw connection to get a single transaction.
+        conn = self.db.db[(domain_id, NAME_OF_DB)]
+        try:
+            conn.execute('begin immediate')
+            conn.executemany(
+                    'insert into tx_table values (?, ?, ?, ?, ?, ?, ?)',
+                    rows)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def write_user(self, user, table):
+        self.db.exec_sql(domain_id, NAME_OF_DB,
+                self._sql('insert into %s values (?, ?, ?, ?)', table),
+                user.user_id, user.name,
+                user.keypair.public_key, user.keypair.private_key)
+
+
+_cached_connections = []
+
+
+@lru_cache(maxsize=128)
+def _get_id_pubkey_map(domain_id):
+    idPubkeyMap = id_lib.BBcIdPublickeyMap(domain_id)
+    _cached_connections.append(idPubkeyMap)
+    return idPubkeyMap
+
+
+def _scale_amount(s, decimal):
+    int_part, _, frac_part = s.partition('.')
+    return int((int_part or '0') + frac_part[:decimal].ljust(decimal, '0'))
+
+
+def _make_amount_formatter(decimal, scale):
+    if decimal <= 0:
+        return str
+
+    def fmt(value):
+        sign = '-' if value < 0 else ''
+        q, r = divmod(abs(value), scale)
+        return f'{sign}{q}.{r:0{decimal}d}'
+
+    return fmt
+
+
+# Cached mint connection plus the constants derived from its currency
+# spec: scale = 10 ** decimal and a formatter from scaled integer value
+# to decimal string.
+MintCtx = namedtuple('MintCtx', 'mint spec scale fmt')
+
+
+@lru_cache(maxsize=128)
+def _get_mint(domain_id, mint_id):
+    mint = token_lib.BBcMint(domain_id, mint_id, mint_id,
+            _get_id_pubkey_map(domain_id))
+    _cached_connections.append(mint)
+    spec = mint.get_currency_spec()
+    scale = 10 ** spec.decimal
+    return MintCtx(mint, spec, scale,
+            _make_amount_formatter(spec.decimal, scale))
+
+
+@atexit.register
+def _close_cached_connections():
+    while len(_cached_connections) > 0:
+        _cached_connections.pop().close()
+
+
+class OrjsonProvider(JSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Flask(__name__)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+
+def from_hex_to_user(store, user_id_str, table):
+    user_id = bytes.fromhex(user_id_str)
+    user = store.get_user(user_id, table)
+    if user is None:
+        abort(404, description='user {0} is not found'.format(user_id_str))
+    return user
+
+
+@app.before_request
+def before_request():
+    g.store = Store()
+
+
+@app.teardown_request
+def teardown_request(exc):
+    # sqlite connections must be closed on the thread that created
+    # them; teardown_request runs there, after the response is built.
+    store = g.pop('store', None)
+    if store is not None:
+        store.close()
+
+
+@app.route('/user', methods=['POST'])
+def define_user():
+    name = request.form.get('name')
+    if name is None or len(name) <= 0:
+        abort(400, description='name is missing')
+    taken = g.store.name_taken(name)
+    if taken == 'user':
+        abort(409, description='user {0} already exists'.format(name))
+    elif taken is not None:
+        abort(409, description='{0} is used for a currency'.format(name))
+    idPubkeyMap = _get_id_pubkey_map(domain_id)
+    user_id, keypairs = idPubkeyMap.create_user_id(num_pubkeys=1)
+    user = User(user_id, name, keypairs[0])
+    g.store.write_user(user, 'user_table')
+    return jsonify({
+        'user_id': user_id.hex(),
+        'name': name,
+    })
+
+
+@app.route('/user', methods=['GET'])
+def show_user():
+    name = request.args.get('name')
+    if name is None or len(name) <= 0:
+        abort(400, description='name is missing')
+    user = g.store.read_user(name, 'user_table')
+    if user is None:
+        abort(404, description='user {0} is not found'.format(name))
+    idPubkeyMap = _get_id_pubkey_map(domain_id)
+    pubkeys = idPubkeyMap.get_mapped_public_keys(user.user_id)
+    return jsonify({
+        'user_id': user.user_id.hex(),
+        'name': user.name,
+        'public_key_count': len(pubkeys),
+    })
+
+
+@app.route('/users', methods=['GET'])
+def list_users():
+    rows = g.store.get_user_names('user_table')
+    dics = [{
+        'user_id': user_id.hex(),
+        'name': name,
+    } for user_id, name in rows]
+    return jsonify({'users': dics})
+
+
+@app.route('/keypair', methods=['PUT'])
+def replace_keypair():
+    user_id_str = request.form.get('user_id')
+    if user_id_str is None or len(user_id_str) <= 0:
+        abort(400, description='user_id is missing')
+    user = from_hex_to_user(g.store, user_id_str, 'user_table')
+    keypair_old = user.keypair
+    keypair = bbclib.KeyPair()
+    keypair.generate()
+    idPubkeyMap = _get_id_pubkey_map(domain_id)
+    idPubkeyMap.update(user.user_id,
+            public_keys_to_add=[keypair.public_key],
+            public_keys_to_remove=[keypair_old.public_key],
+            keypair=keypair_old)
+    user.keypair = keypair
+    g.store.replace_user_keypair(user, 'user_table')
+    return jsonify({'user_id': user_id_str})
+
+
+@app.route('/currency', methods=['POST'])
+def define_currency():
+    name = request.form.get('name')
+    symbol = request.form.get('symbol')
+    decimal = int(request.form.get('decimal', 0))
+    if name is None or len(name) <= 0:
+        abort(400, description='name is missing')
+    if symbol is None or len(symbol) <= 0:
+        abort(400, description='symbol is missing')
+    taken = g.store.name_taken(name)
+    if taken == 'currency':
+        abort(409, description='currency {0} already exists'.format(name))
+    elif taken is not None:
+        abort(409, description='{0} is used for a user'.format(name))
+    idPubkeyMap = _get_id_pubkey_map(domain_id)
+    mint_id, keypairs = idPubkeyMap.create_user_id(num_pubkeys=1)
+    mint = token_lib.BBcMint(domain_id, mint_id, mint_id, idPubkeyMap)
+    currency_spec = token_lib.CurrencySpec({
+        'name': name,
+        'symbol': symbol,
+        'decimal': decimal,
+    })
+    mint.set_condition(0, keypair=keypairs[0])
+    mint.set_currency_spec(currency_spec, keypair=keypairs[0])
+    mint.close()
+    currency = User(mint_id, name, keypairs[0])
+    g.store.write_user(currency, 'currency_table')
+    return jsonify({
+        'mint_id': mint_id.hex(),
+        'name': name,
+        'symbol': symbol,
+    })
+
+
+@app.route('/currencies', methods=['GET'])
+def list_currencies():
+    rows = g.store.get_user_names('currency_table')
+    dics = [{
+        'mint_id': user_id.hex(),
+        'name': name,
+    } for user_id, name in rows]
+    return jsonify({'currencies': dics})
+
+
+@app.route('/issue', methods=['POST'])
+def issue_to_user():
+    mint_id_str = request.form.get('mint_id')
+    user_id_str = request.form.get('user_id')
+    amount = request.form.get('amount')
+    if amount is None or len(amount) <= 0:
+        abort(400, description='amount is missing')
+    mint_user = from_hex_to_user(g.store, mint_id_str, 'currency_table')
+    user = from_hex_to_user(g.store, user_id_str, 'user_table')
+    ctx = _get_mint(domain_id, mint_user.user_id)
+    value = _scale_amount(amount, ctx.spec.decimal)
+    tx = ctx.mint.issue(user.user_id, value, keypair=mint_user.keypair,
+            label=_JOINED_LABEL)
+    g.store.write_tx(tx.transaction_id, int(time.time()),
+            mint_user.user_id, mint_user.name, user.name,
+            ctx.fmt(value), LABEL_JOINED)
+    return jsonify({
+        'mint_id': mint_id_str,
+        'user_id': user_id_str,
+        'amount': amount,
+    })
+
+
+@app.route('/transfer', methods=['POST'])
+def transfer_to_user():
+    mint_id_str = request.form.get('mint_id')
+    from_user_id_str = request.form.get('from_user_id')
+    to_user_id_str = request.form.get('to_user_id')
+    amount = request.form.get('amount')
+    s_label = request.form.get('label', '')
+    if amount is None or len(amount) <= 0:
+        abort(400, description='amount is missing')
+    mint_user = from_hex_to_user(g.store, mint_id_str, 'currency_table')
+    from_user = from_hex_to_user(g.store, from_user_id_str, 'user_table')
+    to_user = from_hex_to_user(g.store, to_user_id_str, 'user_table')
+    ctx = _get_mint(domain_id, mint_user.user_id)
+    value = _scale_amount(amount, ctx.spec.decimal)
+    label = _get_label(s_label) if len(s_label) > 0 else None
+    tx = ctx.mint.transfer(from_user.user_id, to_user.user_id, value,
+            keypair_from=from_user.keypair, keypair_mint=mint_user.keypair,
+            label=label)
+    g.store.write_tx(tx.transaction_id, int(time.time()),
+            mint_user.user_id, from_user.name, to_user.name,
+            ctx.fmt(value), s_label)
+    return jsonify({
+        'mint_id': mint_id_str,
+        'from_user_id': from_user_id_str,
+        'to_user_id': to_user_id_str,
+        'amount': amount,
+    })
+
+
+@app.route('/swap', methods=['POST'])
+def swap_between_users():
+    this_mint_id_str = request.form.get('this_mint_id')
+    that_mint_id_str = request.form.get('that_mint_id')
+    this_user_id_str = request.form.get('this_user_id')
+    that_user_id_str = request.form.get('that_user_id')
+    this_amount = request.form.get('this_amount')
+    that_amount = request.form.get('that_amount')
+    s_label = request.form.get('label', '')
+    if this_amount is None or len(this_amount) <= 0:
+        abort(400, description='this_amount is missing')
+    if that_amount is None or len(that_amount) <= 0:
+        abort(400, description='that_amount is missing')
+    this_mint_user = from_hex_to_user(g.store, this_mint_id_str,
+            'currency_table')
+    that_mint_user = from_hex_to_user(g.store, that_mint_id_str,
+            'currency_table')
+    this_user = from_hex_to_user(g.store, this_user_id_str, 'user_table')
+    that_user = from_hex_to_user(g.store, that_user_id_str, 'user_table')
+    ctx = _get_mint(domain_id, this_mint_user.user_id)
+    counter_ctx = _get_mint(domain_id, that_mint_user.user_id)
+    this_value = _scale_amount(this_amount, ctx.spec.decimal)
+    that_value = _scale_amount(that_amount, counter_ctx.spec.decimal)
+    label = _get_label(s_label) if len(s_label) > 0 else None
+    tx = ctx.mint.swap(counter_ctx.mint, this_user.user_id,
+            that_user.user_id,
+            this_value, that_value,
+            keypair_this=this_user.keypair, keypair_that=that_user.keypair,
+            keypair_mint=this_mint_user.keypair,
+            keypair_counter_mint=that_mint_user.keypair,
+            label=label)
+    timestamp = int(time.time())
+    counter_txid = bytearray(tx.transaction_id)
+    counter_txid.append(0)
+    g.store.write_txs([
+        (tx.transaction_id, timestamp,
+                this_mint_user.user_id, this_user.name, that_user.name,
+                ctx.fmt(this_value), s_label),
+        (bytes(counter_txid), timestamp,
+                that_mint_user.user_id, that_user.name, this_user.name,
+                counter_ctx.fmt(that_value), s_label),
+    ])
+    return jsonify({
+        'this_mint_id': this_mint_id_str,
+        'that_mint_id': that_mint_id_str,
+        'this_user_id': this_user_id_str,
+        'that_user_id': that_user_id_str,
+        'this_amount': this_amount,
+        'that_amount': that_amount,
+    })
+
+
+def _stream_tx_json(count_before, next_rowid, rows):
+    yield '{"count_before": %d, "next_rowid": %s, "transactions": [' % (
+            count_before, 'null' if next_rowid is None else next_rowid)
+    sep = ''
+    for row in rows:
+        yield sep + _dumps(row)
+        sep = ','
+    yield ']}'
+
+
+@app.route('/transactions/<mint_id_str>', methods=['GET'])
+def show_transactions(mint_id_str):
+    mint_id = bytes.fromhex(mint_id_str)
+    name = request.args.get('name')
+    basetime = int(request.args.get('basetime', DEFAULT_BASETIME))
+    after_rowid = request.args.get('after_rowid', type=int)
+    offset = int(request.args.get('offset', 0))
+    count = int(request.args.get('count', DEFAULT_COUNT))
+    count_before, next_rowid, dics = g.store.get_tx_list(mint_id, name=name,
+            basetime=basetime, after_rowid=after_rowid, offset=offset,
+            count=count)
+    return Response(_stream_tx_json(count_before, next_rowid, dics),
+            mimetype='application/json')
+
+
+@app.route('/status/<user_id_str>', methods=['GET'])
+def get_balances_of(user_id_str):
+    user = from_hex_to_user(g.store, user_id_str, 'user_table')
+    rows = g.store.get_user_names('currency_table')
+
+    def _fetch_balance(mint_id):
+        ctx = _get_mint(domain_id, mint_id)
+        value = ctx.mint.get_balance_of(user.user_id)
+        return {
+            'mint_id': mint_id.hex(),
+            'name': ctx.spec.name,
+            'symbol': ctx.spec.symbol,
+            'balance': ctx.fmt(value),
+        }
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        dics = list(executor.map(_fetch_balance,
+                [mint_id for mint_id, _ in rows]))
+    return jsonify({
+        'user_id': user_id_str,
+        'name': user.name,
+        'balances': dics,
+    })
+
+
+@app.errorhandler(400)
+@app.errorhandler(404)
+@app.errorhandler(409)
+def error_handler(e):
+    return jsonify({'error': {
+        'code': e.code,
+        'name': e.name,
+        'message': e.description,
+    }}), e.code
+
+
+if __name__ == '__main__':
+    store = Store()
+    store.setup()
+    store.close()
+    app.run(host='0.0.0.0', port=5000)